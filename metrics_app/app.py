@@ -9,22 +9,25 @@ The service gets a reference dataset from reference.csv file and process current
 
 Metrics calculation results are available with `GET /metrics` HTTP method in Prometheus compatible format.
 """
-import hashlib
 import os
 import numpy as np
+from kernels import rmse_mae
 from utlis import reformat_json
 
 import dataclasses
 import datetime
-from sklearn.metrics import mean_squared_error, mean_absolute_error
 import logging
+import threading
+import time
 from typing import Dict
 from typing import List
 from typing import Optional
 
 import flask
+import orjson
 import pandas as pd
 import prometheus_client
+import xxhash
 from flask import Flask
 import yaml
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
@@ -40,7 +43,9 @@ from evidently.runner.loader import DataOptions
 app = Flask(__name__)
 
 logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", handlers=[logging.StreamHandler()]
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    handlers=[logging.StreamHandler()],
 )
 
 # Add prometheus wsgi middleware to route /metrics requests
@@ -83,8 +88,14 @@ class MonitoringService:
     last_run: Optional[datetime.datetime]
     # collection of reference data
     reference: Dict[str, pd.DataFrame]
-    # collection of current data
-    current: Dict[str, Optional[pd.DataFrame]]
+    # preallocated ring buffers with current data, one array per column
+    _ring: Dict[str, Dict[str, np.ndarray]]
+    # next slot to write in the ring buffer
+    _head: Dict[str, int]
+    # number of filled slots in the ring buffer
+    _count: Dict[str, int]
+    # guards of the ring buffers, requests are served by several threads
+    _locks: Dict[str, threading.Lock]
     # collection of monitoring objects
     monitoring: Dict[str, ModelMonitoring]
     calculation_period_sec: float = 15
@@ -93,109 +104,253 @@ class MonitoringService:
     def __init__(
             self,
             datasets: Dict[str, LoadedDataset],
-            window_size: int
+            window_size: int,
+            calculation_period_sec: float = calculation_period_sec
     ):
+        self.datasets = list(datasets)
         self.reference = {}
         self.monitoring = {}
-        self.current = {}
+        self._ring = {}
+        self._head = {}
+        self._count = {}
+        self._locks = {}
         self.column_mapping = {}
         self.window_size = window_size
+        self.calculation_period_sec = calculation_period_sec
 
         for dataset_info in datasets.values():
-            self.reference[dataset_info.name] = dataset_info.references
+            self.reference[dataset_info.name] = self._contiguous_reference(dataset_info.references)
             self.monitoring[dataset_info.name] = ModelMonitoring(
                 monitors=[EVIDENTLY_MONITORS_MAPPING[k]() for k in dataset_info.monitors], options=[]
             )
             self.column_mapping[dataset_info.name] = dataset_info.column_mapping
+            self._ring[dataset_info.name] = self._allocate_ring(
+                dataset_info.references, dataset_info.column_mapping, window_size
+            )
+            self._head[dataset_info.name] = 0
+            self._count[dataset_info.name] = 0
+            self._locks[dataset_info.name] = threading.Lock()
 
         self.metrics = {}
-        self.next_run_time = {}
-        self.hash = hashlib.sha256(pd.util.hash_pandas_object(self.reference["data_car"]).values).hexdigest()
+        # labelled children of the evidently gauges by metric key and label values
+        self.metric_labels = {}
+        self.hash = self._reference_hash(self.reference["data_car"])
         self.hash_metric = prometheus_client.Gauge("evidently:reference_dataset_hash", "", labelnames=["hash"])
         self.evaluate_metric = prometheus_client.Gauge("evidently:loss_metric", "", labelnames=["loss_function"])
+        self._hash_label = self.hash_metric.labels(hash=self.hash)
+        self._rmse_label = self.evaluate_metric.labels("rmse")
+        self._mae_label = self.evaluate_metric.labels("mae")
+
+        # no value is exported until the first measurement sets it
+        for label in (self._hash_label, self._rmse_label, self._mae_label):
+            label.set(float("nan"))
 
     @staticmethod
-    def rmse(actual, predicted):
-        actual = np.array(actual)
-        predicted = np.array(predicted)
-        return mean_squared_error(actual, predicted, squared=False)
+    def _reference_hash(reference: pd.DataFrame) -> str:
+        """Fingerprint of reference data to detect its changes, it does not need to be cryptographic"""
+        digest = xxhash.xxh64()
+
+        for column in reference.columns:
+            values = reference[column].to_numpy()
+
+            if values.dtype == object:
+                # object arrays hold pointers, hash the values instead
+                values = pd.util.hash_pandas_object(reference[column], index=False).to_numpy()
+
+            digest.update(str(column).encode())
+            digest.update(np.ascontiguousarray(values).tobytes())
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _contiguous_reference(reference: pd.DataFrame) -> pd.DataFrame:
+        """Rebuild reference data from contiguous column arrays, it is read by every measurement"""
+        return pd.DataFrame(
+            {column: np.ascontiguousarray(reference[column].to_numpy()) for column in reference.columns},
+            index=reference.index,
+        )
 
     @staticmethod
-    def mae(actual, predicted):
-        actual = np.array(actual)
-        predicted = np.array(predicted)
-        return mean_absolute_error(actual, predicted)
+    def _allocate_ring(reference: pd.DataFrame, column_mapping: ColumnMapping, window_size: int):
+        """Allocate one array of window size per column, typed after the reference data"""
+        ring = {column: np.empty(window_size, dtype=reference[column].dtype) for column in reference.columns}
 
-    def iterate(self, dataset_name: str, new_rows: pd.DataFrame):
-        """Add data to current dataset for specified dataset"""
+        # reference data can come without predictions, but current data always has them
+        if column_mapping.prediction not in ring:
+            ring[column_mapping.prediction] = np.empty(window_size, dtype=np.float64)
+
+        return ring
+
+    def _current_window(self, dataset_name: str) -> pd.DataFrame:
+        """Build current dataset from the ring buffer, ordered from the oldest row to the newest one"""
+        head = self._head[dataset_name]
+        return pd.DataFrame(
+            {column: np.roll(values, -head) for column, values in self._ring[dataset_name].items()}, copy=False
+        )
+
+    def iterate(self, dataset_name: str, row: Dict):
+        """Add a data row to current dataset for specified dataset"""
         window_size = self.window_size
 
-        if dataset_name in self.current:
-            current_data = self.current[dataset_name].append(new_rows, ignore_index=True)
+        with self._locks[dataset_name]:
+            ring = self._ring[dataset_name]
+            head = self._head[dataset_name]
 
-        else:
-            current_data = new_rows
+            # cast all values before any state changes, a missing or invalid value leaves the window untouched
+            new_values = {column: values.dtype.type(row[column]) for column, values in ring.items()}
+
+            for column, values in ring.items():
+                values[head] = new_values[column]
 
-        current_size = current_data.shape[0]
+            self._head[dataset_name] = (head + 1) % window_size
+            self._count[dataset_name] = min(self._count[dataset_name] + 1, window_size)
 
-        if current_size > self.window_size:
-            # cut current_size by window size value
-            current_data.drop(index=list(range(0, current_size - self.window_size)), inplace=True)
-            current_data.reset_index(drop=True, inplace=True)
+        logging.debug("New row for dataset %s: %s", dataset_name, row)
 
-        self.current[dataset_name] = current_data
+    def iterate_batch(self, dataset_name: str, rows: List[Dict]):
+        """Add several data rows to current dataset for specified dataset with one write per column"""
+        window_size = self.window_size
+        # rows older than the window would be overwritten within the same batch
+        rows = rows[-window_size:]
+        rows_count = len(rows)
 
-        logging.info(current_data)
-        logging.info(new_rows)
-        if current_size < window_size:
-            logging.info(f"Not enough data for measurement: {current_size} of {window_size}." f" Waiting more data")
+        if not rows_count:
             return
 
-        next_run_time = self.next_run_time.get(dataset_name)
+        with self._locks[dataset_name]:
+            ring = self._ring[dataset_name]
+            head = self._head[dataset_name]
+            new_values = {
+                column: np.fromiter((row[column] for row in rows), dtype=values.dtype, count=rows_count)
+                for column, values in ring.items()
+            }
 
-        if next_run_time is not None and next_run_time > datetime.datetime.now():
-            logging.info("Next run for dataset %s at %s", dataset_name, next_run_time)
-            return
+            # the batch is written with two slices at most, the second one after the buffer wraps
+            first_count = min(rows_count, window_size - head)
 
-        self.next_run_time[dataset_name] = datetime.datetime.now() + datetime.timedelta(
-            seconds=self.calculation_period_sec
-        )
+            for column, values in ring.items():
+                values[head:head + first_count] = new_values[column][:first_count]
+                values[:rows_count - first_count] = new_values[column][first_count:]
+
+            self._head[dataset_name] = (head + rows_count) % window_size
+            self._count[dataset_name] = min(self._count[dataset_name] + rows_count, window_size)
+
+        logging.debug("New %s rows for dataset %s", rows_count, dataset_name)
+
+    def run_measurement(self, dataset_name: str):
+        """Run monitors on a snapshot of current data for specified dataset and export the metrics"""
+        window_size = self.window_size
 
+        with self._locks[dataset_name]:
+            current_size = self._count[dataset_name]
+
+            if current_size < window_size:
+                logging.info(f"Not enough data for measurement: {current_size} of {window_size}." f" Waiting more data")
+                return
+
+            current_data = self._current_window(dataset_name)
+
+        # the snapshot is a private copy, writers are not blocked while the kernel runs or compiles
+        column_mapping = self.column_mapping[dataset_name]
+        rmse, mae = rmse_mae(
+            current_data[column_mapping.target].to_numpy(), current_data[column_mapping.prediction].to_numpy()
+        )
         self.monitoring[dataset_name].execute(
             self.reference[dataset_name], current_data, self.column_mapping[dataset_name]
         )
-        self.hash_metric.labels(hash=self.hash).set(1)
-        self.evaluate_metric.labels("rmse").set(self.rmse(current_data['price'], current_data['prediction']))
-        self.evaluate_metric.labels("mae").set(self.mae(current_data['price'], current_data['prediction']))
-
-        for metric, value, labels in self.monitoring[dataset_name].metrics():
-            logging.info("="*50)
-            logging.info(f"{metric.name},{value}, {labels} ")
+        self._hash_label.set(1)
+        self._rmse_label.set(rmse)
+        self._mae_label.set(mae)
+        self._export_metrics(dataset_name, self.monitoring[dataset_name])
+
+    def _export_metrics(self, dataset_name: str, monitoring: ModelMonitoring):
+        """Set prometheus gauges from metrics of an executed monitoring object"""
+        for metric, value, labels in monitoring.metrics():
+            logging.debug("Metric %s for dataset %s: %s, %s", metric.name, dataset_name, value, labels)
             metric_key = f"evidently:{metric.name}"
-            found = self.metrics.get(metric_key)
-
-            if not labels:
-                labels = {}
-
-            labels["dataset_name"] = dataset_name
 
             if isinstance(value, str):
                 continue
 
-            if found is None:
-                found = prometheus_client.Gauge(metric_key, "", list(sorted(labels.keys())))
-                self.metrics[metric_key] = found
-
             try:
-                found.labels(**labels).set(value)
+                self._metric_child(dataset_name, metric_key, labels).set(value)
 
             except ValueError as error:
                 # ignore errors sending other metrics
-                logging.error("Value error for metric %s, error: ", metric_key, error)
+                logging.error("Value error for metric %s, error: %s", metric_key, error)
+
+    def _metric_child(self, dataset_name: str, metric_key: str, labels: Optional[Dict[str, str]]):
+        """Get a labelled child of an evidently gauge, the gauge and the child are created on first use"""
+        if not labels:
+            labels = {}
+
+        labels["dataset_name"] = dataset_name
+        label_key = (metric_key, frozenset(labels.items()))
+        found = self.metric_labels.get(label_key)
+
+        if found is None:
+            gauge = self.metrics.get(metric_key)
+
+            if gauge is None:
+                gauge = prometheus_client.Gauge(metric_key, "", list(sorted(labels.keys())))
+                self.metrics[metric_key] = gauge
+
+            found = gauge.labels(**labels)
+            self.metric_labels[label_key] = found
+
+        return found
+
+    def preregister_metrics(self):
+        """Create gauges for metrics of all monitors before the first measurement, running them on reference data"""
+        for dataset_name in self.datasets:
+            reference = self.reference[dataset_name]
+            column_mapping = self.column_mapping[dataset_name]
+            # a reference sample stands in for current data, its predictions are taken equal to the target
+            sample = reference.tail(self.window_size).reset_index(drop=True)
+
+            if column_mapping.prediction not in sample:
+                sample[column_mapping.prediction] = sample[column_mapping.target].astype(np.float64)
+
+            self.monitoring[dataset_name].execute(reference, sample, column_mapping)
+
+            for metric, value, labels in self.monitoring[dataset_name].metrics():
+                if isinstance(value, str):
+                    continue
+
+                try:
+                    # values from reference data are not real measurements, export no value until the first one
+                    self._metric_child(dataset_name, f"evidently:{metric.name}", labels).set(float("nan"))
+
+                except ValueError as error:
+                    logging.error("Value error for metric %s, error: %s", metric.name, error)
 
 
 SERVICE: Optional[MonitoringService] = None
 
+# errors of rows with missing columns, wrong types or values, they are rejected before changing the window
+INVALID_ROW_ERRORS = (IndexError, KeyError, TypeError, ValueError)
+
+
+def measurement_loop(service: MonitoringService):
+    """Run measurements for all datasets every calculation period, apart from the request handling"""
+    try:
+        service.preregister_metrics()
+
+    except Exception:  # pylint: disable=broad-except
+        # gauges not registered here are created by the first measurement
+        logging.exception("Cannot preregister metrics")
+
+    while True:
+        time.sleep(service.calculation_period_sec)
+
+        for dataset_name in service.datasets:
+            try:
+                service.run_measurement(dataset_name)
+
+            except Exception:  # pylint: disable=broad-except
+                # keep the loop alive, the next period can succeed
+                logging.exception("Measurement failed for dataset %s", dataset_name)
+
 
 @app.before_first_request
 def configure_service():
@@ -242,30 +397,71 @@ def configure_service():
         else:
             logging.info("Dataset %s is not configured in the config file", dataset_name)
 
-    SERVICE = MonitoringService(datasets=datasets, window_size=options.window_size)
+    SERVICE = MonitoringService(
+        datasets=datasets,
+        window_size=options.window_size,
+        calculation_period_sec=options.calculation_period_sec
+    )
+    threading.Thread(target=measurement_loop, args=(SERVICE,), daemon=True).start()
 
 
 @app.route("/iterate/<dataset>", methods=["POST"])
 def iterate(dataset: str):
-    item = flask.request.json
+    try:
+        item = orjson.loads(flask.request.get_data(cache=False))
+
+    except orjson.JSONDecodeError:
+        flask.abort(400)
 
     global SERVICE
     if SERVICE is None:
         return "Internal Server Error: service not found", 500
 
-    if type(item) is list:
-        logging.info("list "*50)
-        logging.info(item)
-        logging.info(type(item[0]))
-        SERVICE.iterate(dataset_name=dataset, new_rows=pd.DataFrame([reformat_json(item[0])]))
-
-    if type(item) is dict:
-        logging.info("dict "*50)
-        logging.info(item)
-        logging.info(reformat_json(item))
-        SERVICE.iterate(dataset_name=dataset, new_rows=pd.DataFrame([reformat_json(item)]))
+    if dataset not in SERVICE.datasets:
+        return f"Not Found: dataset {dataset} is not configured", 404
+
+    try:
+        if type(item) is list:
+            SERVICE.iterate(dataset_name=dataset, row=reformat_json(item[0]))
+
+        if type(item) is dict:
+            SERVICE.iterate(dataset_name=dataset, row=reformat_json(item))
+
+    except INVALID_ROW_ERRORS as error:
+        logging.warning("Invalid data row for dataset %s: %r", dataset, error)
+        flask.abort(400)
+
+    return "ok"
+
+
+@app.route("/iterate_batch/<dataset>", methods=["POST"])
+def iterate_batch(dataset: str):
+    try:
+        items = orjson.loads(flask.request.get_data(cache=False))
+
+    except orjson.JSONDecodeError:
+        flask.abort(400)
+
+    global SERVICE
+    if SERVICE is None:
+        return "Internal Server Error: service not found", 500
+
+    if dataset not in SERVICE.datasets:
+        return f"Not Found: dataset {dataset} is not configured", 404
+
+    if type(items) is dict:
+        items = [items]
+
+    try:
+        if type(items) is list:
+            SERVICE.iterate_batch(dataset_name=dataset, rows=[reformat_json(item) for item in items])
+
+    except INVALID_ROW_ERRORS as error:
+        logging.warning("Invalid data rows for dataset %s: %r", dataset, error)
+        flask.abort(400)
+
     return "ok"
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(threaded=True)
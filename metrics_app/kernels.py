@@ -0,0 +1,24 @@
+import math
+
+import numba
+
+
+@numba.njit(cache=True, fastmath=True)
+def error_sums(actual, predicted):
+    """Sums of squared and absolute errors in a single pass"""
+    sq_sum = 0.0
+    abs_sum = 0.0
+
+    for i in range(actual.shape[0]):
+        error = actual[i] - predicted[i]
+        sq_sum += error * error
+        abs_sum += abs(error)
+
+    return sq_sum, abs_sum
+
+
+@numba.njit(cache=True, fastmath=True)
+def rmse_mae(actual, predicted):
+    sq_sum, abs_sum = error_sums(actual, predicted)
+    size = actual.shape[0]
+    return math.sqrt(sq_sum / size), abs_sum / size
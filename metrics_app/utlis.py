@@ -1,21 +1,26 @@
+import functools
+
 import yaml
 import os
 
+CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")
+INT_NUMERICAL_FEATURE = "year"
 
-def reformat_json(item_json: dict):
-    int_numerical_feature = "year"
-    config_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")
-    with open(config_file_path, "rb") as config_file:
+
+@functools.lru_cache(maxsize=None)
+def categorical_features():
+    # the config is read on the first call only, reformat_json is called for every posted item
+    with open(CONFIG_FILE_PATH, "rb") as config_file:
         config = yaml.safe_load(config_file)
 
-    for cat_feature in config["datasets"]["data_car"]["column_mapping"]["categorical_features"]:
-        val = item_json[cat_feature]
-        val = int(val)
-        item_json[cat_feature] = val
+    return tuple(config["datasets"]["data_car"]["column_mapping"]["categorical_features"])
+
+
+def reformat_json(item_json: dict):
+    for cat_feature in categorical_features():
+        item_json[cat_feature] = int(item_json[cat_feature])
 
-    tmp_val = item_json[int_numerical_feature]
-    tmp_val = int(tmp_val)
-    item_json[int_numerical_feature] = tmp_val
+    item_json[INT_NUMERICAL_FEATURE] = int(item_json[INT_NUMERICAL_FEATURE])
 
     return item_json
 
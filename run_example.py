@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import os
 import logging
+import shutil
 import subprocess
 
 import pandas as pd
@@ -22,10 +22,8 @@ def setup_logger():
 
 
 def check_docker_installation():
-    logging.info("Check docker version")
-    docker_version_result = os.system("docker -v")
-
-    if docker_version_result:
+    logging.info("Check docker installation")
+    if shutil.which("docker") is None:
         exit("Docker was not found. Try to install it with https://www.docker.com")
 
 
@@ -36,7 +34,7 @@ def run_docker_compose():
 
 def run_script(cmd: list, wait: bool) -> None:
     logging.info("Run %s", ' '.join(cmd))
-    script_process = subprocess.Popen(' '.join(cmd), stdout=subprocess.PIPE, shell=True)
+    script_process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
 
     if wait:
         script_process.wait()
@@ -46,11 +44,14 @@ def run_script(cmd: list, wait: bool) -> None:
 
 
 def send_data_requests():
-    os.system("scripts/example_run_request.py")
+    script_process = subprocess.run(["scripts/example_run_request.py"], check=False)
+
+    if script_process.returncode != 0:
+        exit(script_process.returncode)
 
 
 def stop_docker_compose():
-    os.system("docker compose down")
+    subprocess.run(["docker", "compose", "down"], check=False)
 
 
 def main():
@@ -1,6 +1,19 @@
+import os
+
 import pandas as pd
+from joblib import Memory
 from sklearn.ensemble import RandomForestRegressor
 
+# fitted models are cached on disk, re-runs on unchanged reference data skip training
+MEMORY = Memory(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"), verbose=0)
+
+
+@MEMORY.cache
+def fit_model(features: pd.DataFrame, target: pd.Series) -> RandomForestRegressor:
+    model = RandomForestRegressor(random_state=10, n_jobs=-1)
+    model.fit(features, target)
+    return model
+
 
 def prepare_data_car(path_data_refer: str, path_data_product: str) -> pd.DataFrame:
     refer_data_car = pd.read_csv(path_data_refer)
@@ -12,8 +25,7 @@ def prepare_data_car(path_data_refer: str, path_data_product: str) -> pd.DataFra
                             "fuels", "gearbox", "car_type", "wheel_drive"]
 
     feature = numerical_features + categorical_features
-    model = RandomForestRegressor(random_state=10)
-    model.fit(refer_data_car[feature], refer_data_car[target])
+    model = fit_model(refer_data_car[feature], refer_data_car[target])
     product_data_car["prediction"] = model.predict(product_data_car[feature])
 
     return product_data_car
@@ -1,4 +1,7 @@
-from flask import Flask, request
+import logging
+
+import orjson
+from flask import Flask, abort, request
 
 PORT = 6789
 
@@ -7,10 +10,15 @@ app = Flask(__name__)
 
 @app.route("/webhook", methods=['POST'])
 def test():
-    data = request.json
-    print(data)
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+
+    except orjson.JSONDecodeError:
+        abort(400)
+
+    logging.getLogger(__name__).debug("Webhook payload: %s", data)
     ## Add trigger training here
-    return data
+    return orjson.dumps(data), 200, {"Content-Type": "application/json"}
 
 
 if __name__ == '__main__':